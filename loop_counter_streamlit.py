@@ -1,61 +1,108 @@
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pa_parquet
 import streamlit as st
 from datetime import datetime, time, timedelta
 import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import gzip
+import hashlib
+import io
 import json
 import math
 import os
+import pickle
+import threading
+
+# The only report fields used downstream
+REPORT_COLUMNS = ['Vehicle', 'Block', 'Route', 'Trip', 'Stop_Name', 'Direction', 'Timestamp']
+
+# Fixed Arrow types for the cached payload; the other columns keep the type Arrow infers.
+# Stop_Name and Direction are dictionary-encoded so stop checks compare small integer codes
+REPORT_TYPES = {
+    'Route': pa.int32(),
+    'Stop_Name': pa.dictionary(pa.int32(), pa.string()),
+    'Direction': pa.dictionary(pa.int8(), pa.string()),
+}
+
+# Prefer orjson when installed
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+# Per-window API responses are cached here, across reruns and sessions, so overlapping date ranges are not downloaded again
+API_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".api_cache")
+
+# Concurrent API requests per fetch
+FETCH_WORKERS = 8
+
+# Shared across reruns and sessions so connections (and their TLS handshakes) are reused;
+# one pooled connection per fetch worker, with backoff on throttling and server errors
+HTTP_SESSION = requests.Session()
+HTTP_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4, pool_maxsize=FETCH_WORKERS,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+))
+
+# API endpoint selection
+API_ENDPOINTS = {
+    "Stop Report": "https://avail360-api.myavail.cloud/StopReports/v1/CATA/",
+    "Stop Report Detail": "https://avail360-api.myavail.cloud/StopReportsDetail/v1/CATA/"
+}
+
+# Available stops for dropdown selection
+AVAILABLE_STOPS = [
+    "Atherton Hall",
+    "BeaverHill Apts",
+    "Calder Commons",
+    "College_Allen",
+    "Curtin Hall",
+    "Forest Res Lab",
+    "HastinsRd",
+    "IM Building",
+    "J Elliott Bldg",
+    "Jordan Center",
+    "Jordan East Pk",
+    "JordanCtr_GateD",
+    "Lot 43 East",
+    "Lot 83 West",
+    "McCoyNatatorium",
+    "Meridian",
+    "Miln Sc Complex",
+    "Nittany Com Ctr",
+    "Pattee TC EB",
+    "Pattee TC WB",
+    "PavilionTheatre",
+    "Rec Hall",
+    "Schlow Lib_CATA",
+    "Shields Bldg",
+    "VisualArtsBldg",
+    "Walker Building",
+    "Westgate_Bldg",
+    "White Building",
+]
+
+# Route mapping
+ROUTE_MAPPING = {
+    "BL": 55,
+    "WL": 57,
+    "BL Gameday": 955,
+    "WL Gameday": 957
+}
+
+# Logic for dynamic direction based on date
+CUTOFF_DATE = datetime(2026, 1, 12).date()
 
 def main():
     st.title("Bus Data Processor (API to CSV)")
     st.write("Fetch bus stop data from an API for a selected date range, process it to count loops, calculate mileage, and save a summary CSV.")
 
-    # API endpoint selection
-    API_ENDPOINTS = {
-        "Stop Report": "https://avail360-api.myavail.cloud/StopReports/v1/CATA/",
-        "Stop Report Detail": "https://avail360-api.myavail.cloud/StopReportsDetail/v1/CATA/"
-    }
-    
-    # Available stops for dropdown selection
-    AVAILABLE_STOPS = [
-        "Atherton Hall",
-        "BeaverHill Apts",
-        "Calder Commons",
-        "College_Allen",
-        "Curtin Hall",
-        "Forest Res Lab",
-        "HastinsRd",
-        "IM Building",
-        "J Elliott Bldg",
-        "Jordan Center",
-        "Jordan East Pk",
-        "JordanCtr_GateD",
-        "Lot 43 East",
-        "Lot 83 West",
-        "McCoyNatatorium",
-        "Meridian",
-        "Miln Sc Complex",
-        "Nittany Com Ctr",
-        "Pattee TC EB",
-        "Pattee TC WB",
-        "PavilionTheatre",
-        "Rec Hall",
-        "Schlow Lib_CATA",
-        "Shields Bldg",
-        "VisualArtsBldg",
-        "Walker Building",
-        "Westgate_Bldg",
-        "White Building",
-    ]
-    
-    # Route mapping
-    ROUTE_MAPPING = {
-        "BL": 55,
-        "WL": 57,
-        "BL Gameday": 955,
-        "WL Gameday": 957
-    }
-
     st.header("1. Configuration")
     
     api_source = st.selectbox(
@@ -86,9 +133,6 @@ def main():
         st.error("Start date cannot be after the end date.")
         return
 
-    # Logic for dynamic direction based on date
-    CUTOFF_DATE = datetime(2026, 1, 12).date()
-    
     col_r1, col_r2 = st.columns(2)
     with col_r1:
         route_loop = st.selectbox("Route Loop", list(ROUTE_MAPPING.keys()), help="Select the route loop to analyze")
@@ -107,6 +151,8 @@ def main():
     with col_s2:
         end_stop = st.selectbox("End Stop", AVAILABLE_STOPS, index=0)
 
+    force_refresh = st.checkbox("Force refresh", help="Re-download the selected date range instead of using cached API responses")
+
     # Action Buttons
     col_btn1, col_btn2 = st.columns([3, 1])
     with col_btn1:
@@ -115,11 +161,12 @@ def main():
     with col_btn2:
         if st.session_state.get('fetch_triggered', False):
             if st.button("🔄 Clear Results"):
-                for key in ['fetch_triggered', 'cached_data', 'cached_data_key', 'params']:
+                for key in ['fetch_triggered', 'cached_parquet', 'cached_data_key', 'cached_data_id', 'params']:
                     if key in st.session_state: del st.session_state[key]
                 st.rerun()
     
     if fetch_button:
+        if force_refresh: st.session_state.pop('cached_data_key', None)
         st.session_state['fetch_triggered'] = True
         st.session_state['params'] = {
             'start_date': start_date,
@@ -131,7 +178,7 @@ def main():
             'end_stop': end_stop,
             'direction': direction,
             'route_filter': ROUTE_MAPPING[route_loop],
-            'route_mapping': ROUTE_MAPPING
+            'force_refresh': force_refresh
         }
     
     if st.session_state.get('fetch_triggered', False):
@@ -139,50 +186,48 @@ def main():
         run_full_process(
             p['start_date'], p['end_date'], p['api_key'], p['api_base_url'],
             p['loop_mileage'], p['start_stop'], p['end_stop'],
-            p['direction'], p['route_filter'], p['route_mapping']
+            p['direction'], p['route_filter'], p['force_refresh']
         )
 
-def run_full_process(start_date, end_date, api_key, api_base_url, loop_mileage, start_stop, end_stop, direction_to_keep, route_filter, route_mapping):
+# Runs as a fragment: interactions inside the results (e.g. the download button) rerun only
+# this panel instead of the whole script with all of its configuration widgets
+@st.fragment
+def run_full_process(start_date, end_date, api_key, api_base_url, loop_mileage, start_stop, end_stop, direction_to_keep, route_filter, force_refresh=False):
     start_datetime = datetime.combine(start_date, time(6, 0))
     end_datetime = datetime.combine(end_date + timedelta(days=1), time(3, 0))
 
     cache_key = f"{start_date}_{end_date}_{api_base_url}"
     if 'cached_data_key' not in st.session_state or st.session_state['cached_data_key'] != cache_key:
         with st.spinner("Fetching data from API..."):
-            api_data = fetch_data_in_chunks(start_datetime, end_datetime, api_base_url, api_key)
+            api_data = fetch_data_in_chunks(start_datetime, end_datetime, api_base_url, api_key, force_refresh)
         if not api_data:
             st.info("No data returned from API.")
             return
-        st.session_state['cached_data'] = api_data
+        # Keep the parsed, typed frame as Parquet bytes rather than the raw column lists:
+        # reruns load it straight back with dtypes intact instead of re-parsing
+        try:
+            st.session_state['cached_parquet'] = build_report_parquet(api_data)
+        except Exception as e:
+            st.error(f"Processing error: {e}")
+            return
         st.session_state['cached_data_key'] = cache_key
-    else:
-        api_data = st.session_state['cached_data']
+        st.session_state['cached_data_id'] = f"{cache_key}_{datetime.now().isoformat()}"
+
+    # The cached payload is already a typed Parquet file, so it can be offered as-is
+    st.download_button(
+        "Download API Data (Parquet)", data=st.session_state['cached_parquet'],
+        file_name=f"API_Data_{start_date}_{end_date}.parquet", mime="application/octet-stream"
+    )
             
     with st.spinner("Processing loops..."):
         try:
-            df = pd.DataFrame(api_data)
-            df['Timestamp'] = pd.to_datetime(df['Timestamp'])
-
-            # Route Filtering
-            route_filter_int = int(route_filter)
-            df_route_filtered = df[df['Route'] == route_filter_int].copy()
-            
-            if df_route_filtered.empty:
-                st.error(f"No data found for Route {route_filter_int}")
-                return
-
-            # Direction Filtering (Handling IB, OB, and Both)
-            if direction_to_keep == "Both":
-                df_filtered = df_route_filtered[df_route_filtered['Direction'].isin(["I", "O"])].copy()
-            else:
-                df_filtered = df_route_filtered[df_route_filtered['Direction'] == direction_to_keep].copy()
-
-            if df_filtered.empty:
-                st.error(f"No data found for Direction '{direction_to_keep}'")
+            loop_events, error = compute_loops(
+                st.session_state['cached_data_id'], st.session_state['cached_parquet'], route_filter,
+                direction_to_keep, start_stop, end_stop, loop_mileage
+            )
+            if error:
+                st.error(error)
                 return
-
-            df_filtered.sort_values(by=['Block', 'Timestamp'], inplace=True)
-            loop_events = get_loop_events(df_filtered, loop_mileage, start_stop, end_stop)
             
             if loop_events.empty:
                 st.error("No complete loops were found.")
@@ -193,100 +238,227 @@ def run_full_process(start_date, end_date, api_key, api_base_url, loop_mileage,
         except Exception as e:
             st.error(f"Processing error: {e}")
 
-def fetch_data_in_chunks(start_date, end_date, api_base_url, api_key):
-    all_reports = []
-    current_start = start_date
-    total_hours = (end_date - start_date).total_seconds() / 3600
-    
-    progress_bar = st.progress(0)
+def report_array(column, values):
+    try:
+        return pa.array(values, type=REPORT_TYPES.get(column))
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        pass
+    # Values of mixed or unexpected types: like == on a pandas object column, only integer
+    # routes can match the selected route; other columns fall back to their string form
+    if column == 'Route':
+        return pa.array([v if is_route_number(v) else None for v in values], type=pa.int64())
+    return pa.array([None if v is None else str(v) for v in values], type=REPORT_TYPES.get(column, pa.string()))
+
+def is_route_number(value):
+    if isinstance(value, bool):
+        return False
+    return isinstance(value, int) or (isinstance(value, float) and value.is_integer())
+
+def build_report_parquet(api_data):
+    # Arrow builds each typed column straight from the fetched lists, skipping pandas' per-cell
+    # dtype inference; only the timestamps go through pandas, parsed as ISO 8601 without format guessing
+    timestamps = pd.to_datetime(pd.Series(api_data['Timestamp']), format='ISO8601')
+    columns = {column: report_array(column, api_data[column]) for column in REPORT_COLUMNS if column != 'Timestamp'}
+    # Integer IDs are narrowed to int32; values that do not fit (or non-numeric IDs) keep the inferred type
+    for column in ['Vehicle', 'Block', 'Trip']:
+        if pa.types.is_integer(columns[column].type):
+            try:
+                columns[column] = columns[column].cast(pa.int32())
+            except pa.ArrowInvalid:
+                pass
+    columns['Timestamp'] = pa.array(timestamps)
+    # Service day rolls over at 6 AM
+    columns['ServiceDay'] = pa.array((timestamps - pd.Timedelta(hours=6)).dt.normalize())
+
+    buffer = io.BytesIO()
+    pa_parquet.write_table(pa.table(columns), buffer, compression='zstd')
+    return buffer.getvalue()
+
+# Reruns with the same data and settings reuse the result. The Parquet payload is not
+# hashed (leading underscore); data_id changes whenever a new payload is fetched.
+@st.cache_data(show_spinner=False, max_entries=32)
+def compute_loops(data_id, _report_parquet, route_filter, direction_to_keep, start_stop, end_stop, loop_mileage):
+    # Route and direction filters (I, O, or both) are pushed down into one Parquet read, so
+    # rows of other routes or directions are never materialized; only the columns
+    # get_loop_events reads are loaded
+    route_filter_int = int(route_filter)
+    directions = ["I", "O"] if direction_to_keep == "Both" else [direction_to_keep]
+    df_filtered = pd.read_parquet(
+        io.BytesIO(_report_parquet),
+        columns=['Vehicle', 'Block', 'Route', 'Trip', 'Stop_Name', 'Timestamp', 'ServiceDay'],
+        filters=[('Route', '==', route_filter_int), ('Direction', 'in', directions)]
+    )
+
+    if df_filtered.empty:
+        # Only work out which filter left nothing when there is an error to report
+        route_rows = pd.read_parquet(io.BytesIO(_report_parquet), columns=['Route'], filters=[('Route', '==', route_filter_int)])
+        if route_rows.empty:
+            return None, f"No data found for Route {route_filter_int}"
+        return None, f"No data found for Direction '{direction_to_keep}'"
+
+    # get_loop_events expects each (Vehicle, Block, Route) group as one contiguous, time-ordered slice
+    df_filtered = df_filtered.sort_values(by=['Vehicle', 'Block', 'Route', 'Timestamp'], kind='mergesort')
+    return get_loop_events(df_filtered, loop_mileage, start_stop, end_stop), None
+
+def fetch_data_in_chunks(start_date, end_date, api_base_url, api_key, force_refresh=False):
+    now = datetime.now()
+    # Cached windows are only served back to the same key; the key itself never reaches the disk
+    key_hash = hashlib.sha256(api_key.encode()).hexdigest()
     
+    # One request per 24-hour window
+    windows = []
+    current_start = start_date
     while current_start < end_date:
         current_end = min(current_start + timedelta(hours=24), end_date)
         start_str = current_start.strftime('%Y-%m-%dT%H:%M:%SZ')
         end_str = current_end.strftime('%Y-%m-%dT%H:%M:%SZ')
         url = f"{api_base_url}{start_str}/{end_str}?subscription-key={api_key}"
-
-        try:
-            response = requests.get(url)
-            response.raise_for_status()
-            data = response.json()
-            if isinstance(data, dict) and "result" in data and "Stop Reports" in data["result"]:
-                reports = data["result"]["Stop Reports"]
-                if reports: all_reports.extend(reports)
-        except Exception as e:
-            st.error(f"Fetch error: {e}")
-            return None
-
-        # Update Progress
-        elapsed_hours = (current_end - start_date).total_seconds() / 3600
-        progress_bar.progress(min(elapsed_hours / total_hours, 1.0))
+        cache_name = hashlib.md5(f"{api_base_url}{start_str}{end_str}{key_hash}".encode()).hexdigest()
+        windows.append({
+            'url': url,
+            'cache_path': os.path.join(API_CACHE_DIR, f"{cache_name}.pkl"),
+            'refresh': force_refresh,
+            'complete': current_end <= now
+        })
         current_start = current_end
     
+    # Windows are independent, so fetch them concurrently over the kept-alive connections of HTTP_SESSION
+    results = [None] * len(windows)
+    
+    progress_bar = st.progress(0)
+    
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        futures = {executor.submit(fetch_window, HTTP_SESSION, window): i for i, window in enumerate(windows)}
+        for done, future in enumerate(as_completed(futures), start=1):
+            try:
+                results[futures[future]] = future.result()
+            except Exception as e:
+                st.error(f"Fetch error: {e}")
+                for pending in futures: pending.cancel()
+                return None
+            
+            # Update Progress
+            progress_bar.progress(done / len(windows))
+    
     progress_bar.empty()
-    return all_reports
+    
+    # Transpose into one list per column (in window order) so the DataFrame is built column-wise
+    api_data = {column: [] for column in REPORT_COLUMNS}
+    for reports in results:
+        if not reports: continue
+        for column, values in api_data.items():
+            values.extend([report.get(column) for report in reports])
+    
+    if not api_data['Timestamp']:
+        return None
+    return api_data
+
+def fetch_window(session, window):
+    # Runs on a worker thread, so decoding one window overlaps the wait on the others
+    cache_path = window['cache_path']
+    if not window['refresh'] and os.path.exists(cache_path):
+        with open(cache_path, 'rb') as f:
+            return pickle.load(f)
+    
+    response = session.get(window['url'], timeout=(5, 60))
+    response.raise_for_status()
+    data = json_loads(response.content)
+    if not (isinstance(data, dict) and "result" in data and "Stop Reports" in data["result"]):
+        # Some other body (e.g. an error or throttling payload); don't cache it
+        return None
+    reports = data["result"]["Stop Reports"]
+    
+    # Windows that have not ended yet are still filling up, so never store them
+    if window['complete']:
+        os.makedirs(API_CACHE_DIR, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(reports, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    return reports
+
+def category_code(values, value):
+    # -2 never matches a code (missing values are -1), so absent stops simply find nothing
+    categories = values.cat.categories
+    return categories.get_loc(value) if value in categories else -2
 
 def get_loop_events(df, loop_mileage, start_stop, end_stop):
-    loop_events = []
-    df_sorted = df.sort_values(['Block', 'Timestamp']).reset_index(drop=True)
+    # df arrives sorted by the group key and Timestamp, so every group is one contiguous, time-ordered slice
+    group_cols = ['Vehicle', 'Block', 'Route']
+    df_sorted = df.reset_index(drop=True)
     
-    def get_service_day(timestamp):
-        ts = pd.to_datetime(timestamp)
-        return ts.date() if ts.hour >= 6 else ts.date() - timedelta(days=1)
+    # Pull the columns out once; everything below works on row positions
+    vehicles = df_sorted['Vehicle'].to_numpy()
+    blocks = df_sorted['Block'].to_numpy()
+    routes = df_sorted['Route'].to_numpy()
+    trips = df_sorted['Trip'].to_numpy()
+    stops = df_sorted['Stop_Name'].cat.codes.to_numpy()
+    timestamps = df_sorted['Timestamp']
+    service_days = df_sorted['ServiceDay'].to_numpy()
+    start_code = category_code(df_sorted['Stop_Name'], start_stop)
+    end_code = category_code(df_sorted['Stop_Name'], end_stop)
+    # Event type per row: 1 = start stop, 2 = end stop, 0 = anything else (start wins if both are the same stop)
+    events = np.where(stops == start_code, 1, np.where(stops == end_code, 2, 0)).astype(np.uint8)
     
-    for (vehicle, block, route), group in df_sorted.groupby(['Vehicle', 'Block', 'Route']):
-        group_sorted = group.sort_values('Timestamp').reset_index(drop=True)
-        trip_loops = {}
-        
-        for i in range(len(group_sorted)):
-            row = group_sorted.iloc[i]
-            stop, trip, ts = row['Stop_Name'], row['Trip'], pd.to_datetime(row['Timestamp'])
-            
-            if trip not in trip_loops:
-                trip_loops[trip] = {'waiting': False, 'start_ts': None, 'start_idx': None}
-            
-            if stop == start_stop:
-                trip_loops[trip] = {'waiting': True, 'start_ts': ts, 'start_idx': i}
-            
-            elif stop == end_stop and trip_loops[trip]['waiting']:
-                trip_loops[trip]['waiting'] = False
-                day = get_service_day(ts)
-                
-                daily_count = len([e for e in loop_events if e['Vehicle'] == vehicle and get_service_day(e['Loop_Completed_At']) == day])
-                loop_count = daily_count + 1
-                
-                loop_events.append({
-                    'Vehicle': vehicle, 'Block': block, 'Route': route, 'Trip': trip,
-                    'Start_Stop': start_stop, 'End_Stop': end_stop,
-                    'Loop_Completed_At': ts.strftime('%Y-%m-%d %H:%M:%S'),
-                    'Loop_Count': loop_count, 'Total_Miles': round(loop_count * loop_mileage, 2),
-                    'Trip_Flip': False, 'End_Trip': trip
-                })
-
-        # Check for Trip Flips
-        for trip_id, state in trip_loops.items():
-            if state['waiting']:
-                idx = state['start_idx']
-                next_rows = group_sorted.iloc[idx+1:]
-                next_trip_data = next_rows[next_rows['Trip'] != trip_id].head(1)
-                
-                if not next_trip_data.empty and next_trip_data.iloc[0]['Stop_Name'] == end_stop:
-                    ts_flip = pd.to_datetime(next_trip_data.iloc[0]['Timestamp'])
-                    day_flip = get_service_day(ts_flip)
-                    daily_count = len([e for e in loop_events if e['Vehicle'] == vehicle and get_service_day(e['Loop_Completed_At']) == day_flip])
-                    loop_count = daily_count + 1
-                    
-                    loop_events.append({
-                        'Vehicle': vehicle, 'Block': block, 'Route': route, 'Trip': trip_id,
-                        'Start_Stop': start_stop, 'End_Stop': end_stop,
-                        'Loop_Completed_At': ts_flip.strftime('%Y-%m-%d %H:%M:%S'),
-                        'Loop_Count': loop_count, 'Total_Miles': round(loop_count * loop_mileage, 2),
-                        'Trip_Flip': True, 'End_Trip': next_trip_data.iloc[0]['Trip']
-                    })
-
-    ev_df = pd.DataFrame(loop_events)
+    # Group boundaries are wherever any part of the key changes
+    new_group = np.zeros(len(df_sorted), dtype=bool)
+    new_group[:1] = True
+    for col in group_cols:
+        values = df_sorted[col]
+        values = values.cat.codes.to_numpy() if isinstance(values.dtype, pd.CategoricalDtype) else values.to_numpy()
+        new_group[1:] |= values[1:] != values[:-1]
+    group_ids = np.cumsum(new_group) - 1
+    trip_codes = pd.factorize(trips)[0]
+    
+    # Start/end rows of each (group, trip) in time order, for the whole frame at once
+    # (lexsort is stable). An end completes a loop only when the previous start/end
+    # row of the same trip was a start.
+    marked = np.flatnonzero(events)
+    marked = marked[np.lexsort((trip_codes[marked], group_ids[marked]))]
+    same_trip = (group_ids[marked[1:]] == group_ids[marked[:-1]]) & (trip_codes[marked[1:]] == trip_codes[marked[:-1]])
+    marked_events = events[marked]
+    completes = np.zeros(len(marked), dtype=bool)
+    completes[1:] = same_trip & (marked_events[:-1] == 1) & (marked_events[1:] == 2)
+    completed = marked[completes]
+    
+    # Check for Trip Flips: a trip whose last start never reached the end stop still completes
+    # the loop if the next row of another trip in the same group is at the end stop
+    last_of_trip = np.ones(len(marked), dtype=bool)
+    last_of_trip[:-1] = ~same_trip
+    open_starts = marked[last_of_trip & (marked_events == 1)]
+    new_run = new_group.copy()
+    new_run[1:] |= trip_codes[1:] != trip_codes[:-1]
+    run_starts = np.append(np.flatnonzero(new_run), len(df_sorted))
+    next_trip_rows = run_starts[np.searchsorted(run_starts, open_starts, side='right')]
+    flips = next_trip_rows < len(df_sorted)
+    flips[flips] = ~new_group[next_trip_rows[flips]] & (stops[next_trip_rows[flips]] == end_code)
+    flip_starts, flip_ends = open_starts[flips], next_trip_rows[flips]
+    
+    # Emit group by group: completions in time order, then flips in the order their trips first appear
+    trip_keys = group_ids * len(df_sorted) + trip_codes
+    unique_keys, first_seen = np.unique(trip_keys, return_index=True)
+    flip_first_seen = first_seen[np.searchsorted(unique_keys, trip_keys[flip_starts])]
+    
+    event_rows = np.concatenate([completed, flip_starts])
+    end_rows = np.concatenate([completed, flip_ends])
+    trip_flips = np.concatenate([np.zeros(len(completed), dtype=bool), np.ones(len(flip_starts), dtype=bool)])
+    order = np.lexsort((np.concatenate([completed, flip_first_seen]), trip_flips, group_ids[event_rows]))
+    
+    event_rows, end_rows, trip_flips = event_rows[order], end_rows[order], trip_flips[order]
+    
+    # Loop_Count is the running number of loops for the vehicle on that service day, in emission order
+    loop_counts = pd.DataFrame({'Vehicle': vehicles[event_rows], 'ServiceDay': service_days[end_rows]}).groupby(
+        ['Vehicle', 'ServiceDay'], sort=False).cumcount().to_numpy(dtype=np.int32) + 1
+    
+    ev_df = pd.DataFrame({
+        'Vehicle': vehicles[event_rows], 'Block': blocks[event_rows], 'Route': routes[event_rows], 'Trip': trips[event_rows],
+        'Start_Stop': start_stop, 'End_Stop': end_stop,
+        'Loop_Completed_At': timestamps.array[end_rows],
+        'Loop_Count': loop_counts, 'Total_Miles': np.round(loop_counts * loop_mileage, 2),
+        'Trip_Flip': trip_flips, 'End_Trip': trips[end_rows]
+    })
     if not ev_df.empty:
-        ev_df['sort_ts'] = pd.to_datetime(ev_df['Loop_Completed_At'])
-        ev_df = ev_df.sort_values(['Block', 'sort_ts']).drop('sort_ts', axis=1)
+        ev_df = ev_df.sort_values(['Block', 'Loop_Completed_At'], kind='mergesort')
     return ev_df.reset_index(drop=True)
 
 def save_loop_events(df, mileage):
@@ -294,11 +466,16 @@ def save_loop_events(df, mileage):
     total_m = round(total_l * mileage, 2)
     flips = df['Trip_Flip'].sum() if 'Trip_Flip' in df.columns else 0
     
-    summary_row = pd.DataFrame([{'Vehicle': 'Total', 'Loop_Count': total_l, 'Total_Miles': total_m, 'Trip_Flip': f'{flips} flips'}])
-    final_csv = pd.concat([df, summary_row], ignore_index=True).to_csv(index=False)
+    summary_row = {'Vehicle': 'Total', 'Loop_Count': total_l, 'Total_Miles': total_m, 'Trip_Flip': f'{flips} flips'}
+    compress = st.checkbox("Compress download (gzip)", value=True, help="Untick to download a plain CSV")
+    # The CSV is only built when the button is clicked (then served from the cache)
+    final_csv = lambda: loop_events_csv(df, summary_row, compress)
     
     st.success(f"Processed {total_l} loops ({total_m} miles).")
-    st.download_button("Download CSV", data=final_csv, file_name="Bus_Loops.csv", mime="text/csv")
+    if compress:
+        st.download_button("Download CSV", data=final_csv, file_name="Bus_Loops.csv.gz", mime="application/gzip")
+    else:
+        st.download_button("Download CSV", data=final_csv, file_name="Bus_Loops.csv", mime="text/csv")
     
     st.header("Summary")
     c1, c2, c3 = st.columns(3)
@@ -307,5 +484,22 @@ def save_loop_events(df, mileage):
     c3.metric("Flips", flips)
     st.dataframe(df, use_container_width=True)
 
+# Widget changes rerun the whole script; the CSV is only rebuilt when the loop events change
+@st.cache_data(show_spinner=False, max_entries=32)
+def loop_events_csv(df, summary_row, compress=False):
+    # Timestamps stay datetime64 until the CSV is written; flags keep pandas' True/False spelling
+    csv_df = df.assign(
+        Loop_Completed_At=df['Loop_Completed_At'].dt.strftime('%Y-%m-%d %H:%M:%S'),
+        Trip_Flip=np.where(df['Trip_Flip'], 'True', 'False')
+    )
+    
+    # Arrow's CSV writer formats the columns in parallel straight into a byte buffer;
+    # the totals row is appended as one plain line instead of rebuilding the frame around it
+    sink = io.BytesIO()
+    pa_csv.write_csv(pa.Table.from_pandas(csv_df, preserve_index=False), sink)
+    sink.write((",".join(str(summary_row.get(col, "")) for col in df.columns) + "\n").encode())
+    # Optional gzip of the CSV bytes
+    return gzip.compress(sink.getvalue(), compresslevel=6) if compress else sink.getvalue()
+
 if __name__ == "__main__":
     main()